@@ -73,4 +73,9 @@ if [ -z $sess ] || [ -z $task ]; then
     exit 1
 fi
 
+# Cap BLAS and numba threads to the allocation
+for thread_var in OMP_NUM_THREADS OPENBLAS_NUM_THREADS MKL_NUM_THREADS NUMBA_NUM_THREADS; do
+    export $thread_var=${!thread_var:-${SLURM_CPUS_PER_TASK:-1}}
+done
+
 python array_workflow.py -e $sess -t $task
@@ -15,14 +15,18 @@ python array_workflow.py -e ses-day2 -t match
 
 import os
 import sys
+import json
+import shutil
+from pathlib import Path
 from argparse import ArgumentParser, RawTextHelpFormatter
+from classify_rest import helper
 from classify_rest import workflow
-from classify_rest.sql_database import DbConnect
+from classify_rest import sql_database
 
 
 # %%
-def _get_args():
-    """Get and parse arguments."""
+def _build_parser() -> ArgumentParser:
+    """Build argument parser."""
     parser = ArgumentParser(
         description=__doc__, formatter_class=RawTextHelpFormatter
     )
@@ -44,11 +48,58 @@ def _get_args():
         required=True,
     )
 
+    return parser
+
+
+_PARSER = _build_parser()
+
+
+def _get_args():
+    """Get and parse arguments."""
     if len(sys.argv) == 1:
-        parser.print_help(sys.stderr)
+        _PARSER.print_help(sys.stderr)
         sys.exit(0)
 
-    return parser
+    return _PARSER
+
+
+# %%
+def _get_subj_list(array_dir: str, proj_name: str, sess: str) -> list:
+    """Return subject list, query db_emorep once per array job.
+
+    The first task of an array job to find no cache queries db_emorep
+    and writes subj_list_<proj>_<sess>.json to array_dir, other tasks
+    of the same array job read the cached file. array_dir is keyed on
+    SLURM_ARRAY_JOB_ID, so later submissions see subjects added to
+    db_emorep since.
+
+    """
+    subj_json = os.path.join(array_dir, f"subj_list_{proj_name}_{sess}.json")
+    with helper.file_lock(subj_json):
+        if os.path.exists(subj_json):
+            with open(subj_json) as jf:
+                return json.load(jf)
+
+        # Specify subjects for sbatch array, len(subj_list) should
+        # match --array of submit_array.sh
+        subj_list = sql_database.get_rest_subjs()
+        with open(subj_json, "w") as jf:
+            json.dump(subj_list, jf)
+        return subj_list
+
+
+def _finish_task(array_dir: str):
+    """Count finished task, last task of array job removes array_dir."""
+    done_path = os.path.join(array_dir, "tasks_done")
+    with helper.file_lock(done_path):
+        num_done = 1
+        if os.path.exists(done_path):
+            with open(done_path) as df:
+                num_done += int(df.read())
+        with open(done_path, "w") as df:
+            df.write(str(num_done))
+    if num_done >= int(os.environ["SLURM_ARRAY_TASK_COUNT"]):
+        shutil.rmtree(array_dir, ignore_errors=True)
 
 
 # %%
@@ -58,20 +109,6 @@ def main():
     sess = args.sess
     task_name = args.task
 
-    # Specify subjects for sbatch array, len(subj_list) should
-    # match --array of submit_array.sh
-    db_con = DbConnect()
-    query = (
-        "select distinct subj_name from ref_subj a "
-        + "join tbl_rest_ratings b on a.subj_id=b.subj_id"
-    )
-    subj_list = [f"sub-{x[0]}" for x in db_con.fetch_rows(query)]
-    db_con.close_con()
-
-    # Identify subject
-    idx = int(os.environ["SLURM_ARRAY_TASK_ID"])
-    subj = subj_list[idx]
-
     # Setup required args
     # TODO support other model, masks, contrast names
     proj_name = "emorep"
@@ -82,25 +119,37 @@ def main():
     log_dir = f"/work/{os.environ['USER']}/EmoRep/logs/classify_rest_batch"
     mask_sig = True
 
-    # Setup working directories
-    for _dir in [work_deriv, log_dir]:
-        if not os.path.exists(_dir):
-            os.makedirs(_dir)
-
-    # Trigger work
-    cr = workflow.ClassRest(
-        subj,
-        sess,
-        proj_name,
-        mask_name,
-        model_name,
-        task_name,
-        con_name,
-        work_deriv,
-        log_dir,
-        mask_sig,
+    array_dir = os.path.join(
+        work_deriv, f".array_{os.environ['SLURM_ARRAY_JOB_ID']}"
     )
-    cr.label_vols()
+
+    # Setup working directories
+    for _dir in [work_deriv, log_dir, array_dir]:
+        Path(_dir).mkdir(parents=True, exist_ok=True)
+
+    # Count task as finished even on failure, so array_dir is removed
+    try:
+        # Identify subject
+        subj_list = _get_subj_list(array_dir, proj_name, sess)
+        idx = int(os.environ["SLURM_ARRAY_TASK_ID"])
+        subj = subj_list[idx]
+
+        # Trigger work
+        cr = workflow.ClassRest(
+            subj,
+            sess,
+            proj_name,
+            mask_name,
+            model_name,
+            task_name,
+            con_name,
+            work_deriv,
+            log_dir,
+            mask_sig,
+        )
+        cr.label_vols()
+    finally:
+        _finish_task(array_dir)
 
 
 if __name__ == "__main__":
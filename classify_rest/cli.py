@@ -11,7 +11,6 @@ Notes
 -----
 - Requires the following global variables in user environment:
     - RSA_LS2 : location of RSA key to labarserv2
-    - SING_AFNI : location of AFNI singularity image
     - SQL_PASS : password for mysql db_emorep
 - Options contrast-name, model-name, and task-name are used
     to idenfity the classifier (and reflect which data the
@@ -38,18 +37,39 @@ classify_rest \
 # %%
 import os
 import sys
-import time
-import textwrap
 from datetime import datetime
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from argparse import ArgumentParser, RawTextHelpFormatter
 import classify_rest._version as ver
 from classify_rest import helper
 from classify_rest import submit
-
+from classify_rest import sql_database
 
 # %%
-def _get_args():
-    """Get and parse arguments."""
+# Pre-dedented help strings
+_HELP_CON = """\
+Contrast name of classifier
+(default : %(default)s)
+"""
+_HELP_MASK = """\
+Select template mask
+(default : %(default)s)
+"""
+_HELP_MODEL = """\
+FSL model name of classifier
+(default : %(default)s)
+"""
+_HELP_TASK = """\
+Classifier name (informs which data classifier was trained
+on). 'match' to use movie classifier on movie sessions
+and scenario classifier on scenario sessions.
+(default : %(default)s)
+"""
+
+
+def _build_parser() -> ArgumentParser:
+    """Build argument parser."""
     ver_info = f"\nVersion : {ver.__version__}\n\n"
     parser = ArgumentParser(
         description=ver_info + __doc__, formatter_class=RawTextHelpFormatter
@@ -58,23 +78,13 @@ def _get_args():
         "--contrast-name",
         choices=["stim", "replay", "tog"],
         default="stim",
-        help=textwrap.dedent(
-            """\
-            Contrast name of classifier
-            (default : %(default)s)
-            """
-        ),
+        help=_HELP_CON,
     )
     parser.add_argument(
         "--mask-name",
         choices=["tpl_GM_mask.nii.gz"],
         default="tpl_GM_mask.nii.gz",
-        help=textwrap.dedent(
-            """\
-            Select template mask
-            (default : %(default)s)
-            """
-        ),
+        help=_HELP_MASK,
     )
     parser.add_argument(
         "--mask-sig",
@@ -85,12 +95,7 @@ def _get_args():
         "--model-name",
         choices=["sep", "tog"],
         default="sep",
-        help=textwrap.dedent(
-            """\
-            FSL model name of classifier
-            (default : %(default)s)
-            """
-        ),
+        help=_HELP_MODEL,
     )
     parser.add_argument(
         "--no-setup",
@@ -101,14 +106,7 @@ def _get_args():
         "--task-name",
         choices=["movies", "scenarios", "both", "match"],
         default="match",
-        help=textwrap.dedent(
-            """\
-            Classifier name (informs which data classifier was trained
-            on). 'match' to use movie classifier on movie sessions
-            and scenario classifier on scenario sessions.
-            (default : %(default)s)
-            """
-        ),
+        help=_HELP_TASK,
     )
 
     required_args = parser.add_argument_group("Required Arguments")
@@ -138,11 +136,19 @@ def _get_args():
         required=True,
     )
 
+    return parser
+
+
+_PARSER = _build_parser()
+
+
+def _get_args():
+    """Get and parse arguments."""
     if len(sys.argv) == 1:
-        parser.print_help(sys.stderr)
+        _PARSER.print_help(sys.stderr)
         sys.exit(0)
 
-    return parser
+    return _PARSER
 
 
 # %%
@@ -163,7 +169,6 @@ def main():
 
     # Check arguments
     helper.check_rsa()
-    helper.check_afni()
     helper.check_sql_pass()
     helper.check_proj_sess(proj_name, sess_list)
 
@@ -181,8 +186,7 @@ def main():
         f"classify_rest_{now_time.strftime('%y%m%d_%H%M')}",
     )
     for chk_dir in [work_deriv, log_dir]:
-        if not os.path.exists(chk_dir):
-            os.makedirs(chk_dir)
+        Path(chk_dir).mkdir(parents=True, exist_ok=True)
 
     # Download classifier weights and mask
     if not no_setup:
@@ -197,23 +201,55 @@ def main():
             mask_sig,
         )
 
-    # Conduct workflow for each subject, session
+    # Resolve classifier task for each subject, session, then skip
+    # those already in db_emorep.tbl_dotprod_*, each with a single
+    # query, avoiding their download and scheduling
+    pair_list = [(x, y) for x in subj_list for y in sess_list]
+    if task_name == "match":
+        task_map = sql_database.get_sess_names(pair_list)
+    else:
+        task_map = {x: task_name for x in pair_list}
+    sql_database.prime_db_check(proj_name)
+    subj_sess = []
+    for subj, sess in pair_list:
+        chk_task = task_map.get((subj, sess))
+        if chk_task is None:
+            print(f"No session task found for {subj}, {sess}. Skipping")
+            continue
+        if sql_database.db_check(subj, sess, proj_name, chk_task):
+            print(f"Data found for {subj}, {sess}, {chk_task}. Skipping")
+            continue
+        subj_sess.append((subj, sess))
+    sql_database.close_db()
+
+    # Find and download rest data for all subjects, sessions at once
+    with helper.DataSync(proj_name, work_deriv) as ds:
+        subj_sess = ds.prefetch_manifest(subj_sess)
+        ds.dl_rest_batch(subj_sess)
+
+    # Conduct workflow for each subject, session, submitting sbatch
+    # jobs in parallel
     print("Submitting workflow ...")
-    for subj in subj_list:
-        for sess in sess_list:
-            submit.sched_workflow(
+    num_workers = int(os.environ.get("CR_SUBMIT_WORKERS", 8))
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(
+                submit.sched_workflow,
                 subj,
                 sess,
                 proj_name,
                 mask_name,
                 model_name,
-                task_name,
+                task_map[(subj, sess)],
                 con_name,
                 work_deriv,
                 log_dir,
                 mask_sig,
             )
-            time.sleep(3)
+            for subj, sess in subj_sess
+        ]
+        for future in as_completed(futures):
+            future.result()
 
 
 if __name__ == "__main__":
@@ -1,48 +1,39 @@
 """Helper methods.
 
 check_rsa : check env for RSA key
-check_afni : check env for afni singularity path
 chk_sql_pass : check env for mysql password
 check_proj_sess : check if proj_name, sess list match
 KeokiPaths : supply addresses and paths for labarserv2, keoki
 DataSync : manage data down/uploads
+file_lock : hold an exclusive lock across jobs
 
 """
 
 import os
-import glob
+import fcntl
+import shlex
+import shutil
+import subprocess
+import functools
+import uuid
+import weakref
+import tempfile
+from pathlib import Path
 from typing import Tuple, Union
-from classify_rest import submit
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 
 def check_rsa():
     """Check if RSA_LS2 exists in env."""
-    try:
-        os.environ["RSA_LS2"]
-    except KeyError as e:
-        raise Exception(
-            "No global variable 'RSA_LS2' defined in user env"
-        ) from e
-
-
-def check_afni():
-    """Check if SING_AFNI exists in env."""
-    try:
-        os.environ["SING_AFNI"]
-    except KeyError as e:
-        raise Exception(
-            "No global variable 'SING_AFNI' defined in user env"
-        ) from e
+    if "RSA_LS2" not in os.environ:
+        raise Exception("No global variable 'RSA_LS2' defined in user env")
 
 
 def check_sql_pass():
     """Check if SQL_PASS exists in env."""
-    try:
-        os.environ["SQL_PASS"]
-    except KeyError as e:
-        raise Exception(
-            "No global variable 'SQL_PASS' defined in user env"
-        ) from e
+    if "SQL_PASS" not in os.environ:
+        raise Exception("No global variable 'SQL_PASS' defined in user env")
 
 
 def check_proj_sess(proj_name: str, sess_list: list):
@@ -66,17 +57,17 @@ class KeokiPaths:
         """Initialize."""
         self._proj_name = proj_name
 
-    @property
+    @functools.cached_property
     def labarserv2_ip(self) -> str:
         """Return local IP of labarserv2."""
         return "ccn-labarserv2.vm.duke.edu"
 
-    @property
+    @functools.cached_property
     def keoki_emorep(self) -> Union[str, os.PathLike]:
         """Return project parent directory path on Keoki."""
         return "/mnt/keoki/experiments2/EmoRep"
 
-    @property
+    @functools.cached_property
     def keoki_deriv(self) -> Union[str, os.PathLike]:
         """Return project derivatives path on Keoki."""
         mri_dir = (
@@ -93,7 +84,10 @@ class DataSync(KeokiPaths):
     Download data from, and upload data to, Keoki using
     labarserv2.
 
-    Inherits _KeokiPaths.
+    Inherits _KeokiPaths. Use as a context manager to hold a single
+    multiplexed ssh connection open for all transfers. The ssh control
+    master is otherwise stopped when the instance is garbage collected,
+    or at interpreter exit.
 
     Methods
     -------
@@ -104,23 +98,85 @@ class DataSync(KeokiPaths):
         Download classifier weights
     dl_rest()
         Download cleaned resting state data (res4d.nii.gz)
+    dl_rest_batch()
+        Download cleaned resting state data for multiple subjects,
+        sessions in a single rsync call
+    prefetch_manifest()
+        Check Keoki for cleaned resting state data for multiple
+        subjects, sessions in a single ssh call
     ul_rest()
         Upload workflow output to Keoki
+    clean_work()
+        Remove subject, session working files
 
     """
 
+    # Paths verified to exist, shared across instances
+    _existing_paths = set()
+
     def __init__(self, proj_name: str, work_deriv: Union[str, os.PathLike]):
         """Initialize."""
         check_rsa()
         self._work_deriv = work_deriv
         self._user = os.environ["USER"]
+        self._rs_name = "res4d.nii.gz"
+        self._remote_available = None
+        self._present = (
+            set(os.listdir(work_deriv)) if os.path.isdir(work_deriv) else set()
+        )
+        self._backend = os.environ.get("SYNC_BACKEND", "rsync")
+        self._ctl_path = f"/tmp/rsync-ctl-{os.getpid()}-{uuid.uuid4().hex}"
         super().__init__(proj_name)
+        self._src_prefix = f"{self._user}@{self.labarserv2_ip}:"
+        self._stop_master = weakref.finalize(
+            self,
+            _stop_master,
+            self._ctl_path,
+            f"{self._user}@{self.labarserv2_ip}",
+        )
+
+    def _submit(self, job_cmd: list, **kwargs) -> Tuple:
+        """Execute job_cmd via submit.submit_subprocess.
+
+        submit is imported here so validation-only users of helper
+        do not pay for it at import.
+
+        """
+        from classify_rest import submit
+
+        return submit.submit_subprocess(job_cmd, **kwargs)
+
+    def __enter__(self):
+        """Start ssh control master for connection reuse.
+
+        The backgrounded master would hold a stdout pipe open, so
+        stdout goes to DEVNULL and only stderr is captured.
+
+        """
+        job_sp = subprocess.run(
+            self._ssh_argv + ["-MNf", f"{self._user}@{self.labarserv2_ip}"],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+        if job_sp.returncode != 0:
+            raise Exception(
+                "Failed to start ssh control master :\n"
+                + job_sp.stderr.decode("utf-8")
+            )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stop ssh control master."""
+        self._stop_master()
 
     def dl_gm_mask(self, mask_name) -> Union[str, os.PathLike]:
         """Download tpl_GM_mask.nii.gz, return file path."""
-        out_path = os.path.join(self._work_deriv, mask_name)
-        if os.path.exists(out_path):
-            return out_path
+        return _dl_gm_mask_cached(self._proj_name, self._work_deriv, mask_name)
+
+    def _get_gm_mask(self, mask_name) -> Union[str, os.PathLike]:
+        """Download tpl_GM_mask.nii.gz if needed, return file path."""
+        if mask_name in self._present:
+            return os.path.join(self._work_deriv, mask_name)
 
         # Download template from Exp2, return file path
         src_path = os.path.join(
@@ -130,31 +186,132 @@ class DataSync(KeokiPaths):
         )
         return self._dl_file(src_path)
 
+    def _path_exists(self, file_path: Union[str, os.PathLike]) -> bool:
+        """Check for file_path, remembering found paths."""
+        if file_path in self._existing_paths:
+            return True
+        if os.path.exists(file_path):
+            self._existing_paths.add(file_path)
+            return True
+        return False
+
+    def _forget_paths(self, par_dir: Union[str, os.PathLike]):
+        """Drop remembered paths within par_dir."""
+        for file_path in [
+            x for x in self._existing_paths if x.startswith(par_dir)
+        ]:
+            self._existing_paths.discard(file_path)
+
     def _dl_file(
         self, file_path: Union[str, os.PathLike]
     ) -> Union[str, os.PathLike]:
         """Submit download command for file, return file path."""
+        chk_dl = os.path.join(self._work_deriv, os.path.basename(file_path))
+
+        # Check for download by another job, a concurrent duplicate
+        # download is harmless as rsync writes a temp file and renames
+        if os.path.exists(chk_dl):
+            self._present.add(os.path.basename(chk_dl))
+            return chk_dl
+
         print(f"Downloading : {os.path.basename(file_path)}")
-        src = f"{self._user}@{self.labarserv2_ip}:{file_path}"
-        _, _ = self._submit_rsync(src, self._work_deriv)
+        rc, _, err = self._rsync_files_from(
+            os.path.dirname(file_path),
+            [os.path.basename(file_path)],
+            self._work_deriv,
+        )
 
-        # Check for file, return path
-        chk_dl = os.path.join(self._work_deriv, os.path.basename(file_path))
-        if not os.path.exists(chk_dl):
-            raise FileNotFoundError(f"Missing : {chk_dl}")
+        # Trust rsync exit status rather than checking for file
+        if rc != 0:
+            raise FileNotFoundError(
+                f"Missing : {chk_dl}\n{err.decode('utf-8')}"
+            )
+        self._present.add(os.path.basename(chk_dl))
         return chk_dl
 
-    def _submit_rsync(self, src: str, dst: str) -> Tuple:
-        """Execute rsync between DCC and labarserv2."""
-        bash_cmd = f"""\
-            rsync \
-            -e 'ssh -i {os.environ["RSA_LS2"]}' \
-            -rauv {src} {dst}
+    def _submit_rsync(self, src: str, dst: str, include: str = None) -> Tuple:
+        """Execute rsync between DCC and labarserv2.
+
+        Only files matching the include pattern are transferred
+        when specified.
+
         """
-        return submit.submit_subprocess(
-            bash_cmd,
+        if self._backend == "rclone":
+            # Match rsync behavior of copying src dir into dst
+            if os.path.isdir(src):
+                dst = os.path.join(dst, os.path.basename(src))
+            filt = ["--include", include] if include else []
+            return self._submit(
+                ["rclone", "copy"]
+                + self._rclone_opts
+                + filt
+                + [self._rclone_path(src), self._rclone_path(dst)]
+            )
+
+        filt = (
+            [
+                "--prune-empty-dirs",
+                "--include=*/",
+                f"--include={include}",
+                "--exclude=*",
+            ]
+            if include
+            else []
+        )
+        return self._submit(self._rsync_argv + filt + [src, dst])
+
+    @functools.cached_property
+    def _rsync_argv(self) -> list:
+        """Return rsync argv, lacking src and dst."""
+        return ["rsync", "-e", self._ssh_cmd] + self._rsync_opts
+
+    @functools.cached_property
+    def _ssh_cmd(self) -> str:
+        """Return ssh command that multiplexes connections to labarserv2."""
+        return (
+            f"ssh -T -i {os.environ['RSA_LS2']} "
+            + "-o Compression=no "
+            + "-c aes128-gcm@openssh.com "
+            + "-o ControlMaster=auto "
+            + f"-o ControlPath={self._ctl_path} "
+            + "-o ControlPersist=600"
         )
 
+    @functools.cached_property
+    def _ssh_argv(self) -> list:
+        """Return _ssh_cmd as argv, lacking host and remote command."""
+        return shlex.split(self._ssh_cmd)
+
+    @functools.cached_property
+    def _rclone_opts(self) -> list:
+        """Return rclone sftp options for parallel transfer streams."""
+        return [
+            f"--sftp-host={self.labarserv2_ip}",
+            f"--sftp-user={self._user}",
+            f"--sftp-key-file={os.environ['RSA_LS2']}",
+            "--transfers=16",
+            "--checkers=32",
+            "--multi-thread-streams=4",
+        ]
+
+    def _rclone_path(self, path: str) -> str:
+        """Convert rsync user@host:path to rclone :sftp:path."""
+        if path.startswith(self._src_prefix):
+            return f":sftp:{path[len(self._src_prefix):]}"
+        return path
+
+    @functools.cached_property
+    def _rsync_opts(self) -> list:
+        """Return rsync options, verbose only when CR_RSYNC_VERBOSE set.
+
+        Files are written to a temporary name and renamed on
+        completion, so an interrupted transfer never leaves a
+        truncated file at the path checked by later downloads.
+
+        """
+        verb = "v" if os.environ.get("CR_RSYNC_VERBOSE") else ""
+        return [f"-rau{verb}", "--whole-file", "--info=stats2"]
+
     def dl_class_weight(
         self,
         model_name: str,
@@ -162,14 +319,24 @@ class DataSync(KeokiPaths):
         con_name: str,
     ) -> Union[str, os.PathLike]:
         """Download classifier weights, return file path."""
+        return _dl_class_weight_cached(
+            self._proj_name, self._work_deriv, model_name, task_name, con_name
+        )
+
+    def _get_class_weight(
+        self,
+        model_name: str,
+        task_name: str,
+        con_name: str,
+    ) -> Union[str, os.PathLike]:
+        """Download classifier weights if needed, return file path."""
         return
         weight_name = (
             f"level-first_name-{model_name}_task-{task_name}_"
             + f"con-{con_name}Washout_voxel-importance_weighted.tsv"
         )
-        out_path = os.path.join(self._work_deriv, weight_name)
-        if os.path.exists(out_path):
-            return out_path
+        if weight_name in self._present:
+            return os.path.join(self._work_deriv, weight_name)
 
         # Download weight file from Exp2 and return path
         src_path = os.path.join(
@@ -182,69 +349,296 @@ class DataSync(KeokiPaths):
 
     def dl_rest(self, subj: str, sess: str) -> Union[str, os.PathLike]:
         """Download, return file path for subj/sess cleaned rest EPI."""
-        self._subj = subj
-        self._sess = sess
-        self._rs_name = "res4d.nii.gz"
-
         # Check for existing files
-        dst = os.path.join(self._work_deriv, self._subj, self._sess, "func")
-        if not os.path.exists(dst):
-            os.makedirs(dst)
-        res4d_list = sorted(glob.glob(f"{dst}/{self._rs_name}"))
-        if res4d_list:
-            return res4d_list[0]
+        dst = os.path.join(self._work_deriv, subj, sess, "func")
+        res4d = os.path.join(dst, self._rs_name)
+        if self._path_exists(res4d):
+            return res4d
+        Path(dst).mkdir(parents=True, exist_ok=True)
+
+        # Skip download when manifest shows no remote file
+        if (
+            self._remote_available is not None
+            and self._keoki_rs_path(subj, sess) not in self._remote_available
+        ):
+            print(f"No res4d file detected for : {subj}, {sess}")
+            return
 
         # Download, check, and return file path
-        src = f"{self._user}@{self.labarserv2_ip}:{self._keoki_rs_path}"
-        _, _ = self._submit_rsync(src, dst)
-        res4d_list = sorted(glob.glob(f"{dst}/{self._rs_name}"))
-        if not res4d_list:
+        keoki_path = self._keoki_rs_path(subj, sess)
+        rc, _, _ = self._rsync_files_from(
+            os.path.dirname(keoki_path), [os.path.basename(keoki_path)], dst
+        )
+        if rc != 0:
             print(f"No res4d file detected for : {subj}, {sess}")
             return
-        return res4d_list[0]
+        return res4d
+
+    def dl_rest_batch(self, subj_sess: list, workers: int = 8):
+        """Download cleaned rest EPI for all (subj, sess) pairs at once.
+
+        Pairs are split into at most workers groups, each downloaded
+        by one rsync call, and the calls run in parallel. Files are
+        written to the same location as dl_rest, which will then find
+        the existing files. Files of a group whose rsync fails are
+        discarded, leaving those pairs to be downloaded by dl_rest.
+
+        Parameters
+        ----------
+        subj_sess : list
+            [("sub-ER0009", "ses-day2"), ("sub-ER0009", "ses-day3")]
+            Subject and session pairs
+        workers : int, optional
+            Maximum number of simultaneous rsync calls
+
+        """
+        rel_paths = {}
+        for subj, sess in subj_sess:
+            dst = os.path.join(
+                self._work_deriv, subj, sess, "func", self._rs_name
+            )
+            if os.path.isfile(dst):
+                continue
+            rel_paths[dst] = self._rs_rel_path(subj, sess)
+        if not rel_paths:
+            return
+
+        # Download files into staging dir, one rsync per group, then
+        # move files of groups that succeeded to expected locations
+        stage_dir = tempfile.mkdtemp(dir=self._work_deriv)
+        try:
+            dst_list = list(rel_paths.keys())
+            src_root = os.path.join(self.keoki_deriv, "model_fsl")
+            num_groups = max(1, min(workers, len(dst_list)))
+            with ThreadPoolExecutor(max_workers=num_groups) as executor:
+                futures = {
+                    executor.submit(
+                        self._rsync_files_from,
+                        src_root,
+                        [rel_paths[x] for x in dst_list[idx::num_groups]],
+                        stage_dir,
+                    ): dst_list[idx::num_groups]
+                    for idx in range(num_groups)
+                }
+                for future in as_completed(futures):
+                    rc, _, err = future.result()
+                    if rc != 0:
+                        print(
+                            "Failed batch download, deferring to dl_rest "
+                            + f":\n{err.decode('utf-8')}"
+                        )
+                        continue
+                    for dst in futures[future]:
+                        self._move_staged(stage_dir, rel_paths[dst], dst)
+        finally:
+            shutil.rmtree(stage_dir, ignore_errors=True)
+
+    def _move_staged(
+        self,
+        stage_dir: Union[str, os.PathLike],
+        rel_path: str,
+        dst: Union[str, os.PathLike],
+    ):
+        """Move rel_path downloaded within stage_dir to dst."""
+        src = os.path.join(stage_dir, rel_path)
+        if not os.path.isfile(src):
+            print(f"No res4d file detected for : {rel_path}")
+            return
+        Path(dst).parent.mkdir(parents=True, exist_ok=True)
+        os.replace(src, dst)
+
+    def _rsync_files_from(
+        self,
+        src_root: Union[str, os.PathLike],
+        rel_list: list,
+        dst_dir: Union[str, os.PathLike],
+    ) -> Tuple:
+        """Download paths relative to src_root with a single rsync.
+
+        Returns (returncode, stdout, stderr).
+
+        """
+        with tempfile.NamedTemporaryFile(
+            "w", dir=self._work_deriv, suffix=".txt"
+        ) as tf:
+            tf.write("\n".join(rel_list) + "\n")
+            tf.flush()
+            if self._backend == "rclone":
+                return self._submit(
+                    ["rclone", "copy"]
+                    + self._rclone_opts
+                    + [
+                        f"--files-from={tf.name}",
+                        f":sftp:{src_root}",
+                        dst_dir,
+                    ],
+                    return_code=True,
+                )
+
+            return self._submit(
+                self._rsync_argv
+                + [
+                    f"--files-from={tf.name}",
+                    f"{self._src_prefix}{src_root}/",
+                    dst_dir,
+                ],
+                return_code=True,
+            )
+
+    def prefetch_manifest(self, subj_sess: list) -> list:
+        """Check Keoki for all cleaned rest EPI with one ssh call.
+
+        Remote availability is stored and consulted by dl_rest.
+
+        Parameters
+        ----------
+        subj_sess : list
+            [("sub-ER0009", "ses-day2"), ("sub-ER0009", "ses-day3")]
+            Subject and session pairs
+
+        Returns
+        -------
+        list
+            Subject and session pairs having cleaned rest EPI
+            locally or on Keoki
+
+        """
+        src_root = os.path.join(self.keoki_deriv, "model_fsl")
+        remote_paths = {
+            (subj, sess): os.path.join(src_root, self._rs_rel_path(subj, sess))
+            for subj, sess in subj_sess
+        }
+        chk_list = " ".join(shlex.quote(x) for x in remote_paths.values())
+        chk_cmd = (
+            f"for p in {chk_list}; "
+            + 'do [ -e "$p" ] && echo "$p"; done; true'
+        )
+        rc, job_out, err = self._submit(
+            self._ssh_argv
+            + [
+                f"{self._user}@{self.labarserv2_ip}",
+                f"command ; bash -c {shlex.quote(chk_cmd)}",
+            ],
+            return_code=True,
+        )
+
+        # An ssh failure would otherwise read as no remote data
+        if rc != 0:
+            raise Exception(
+                f"Failed to check Keoki for res4d :\n{err.decode('utf-8')}"
+            )
+        self._remote_available = set(job_out.decode("utf-8").splitlines())
+
+        # Keep pairs with local or remote data
+        avail_list = []
+        for subj, sess in subj_sess:
+            local_path = os.path.join(
+                self._work_deriv, subj, sess, "func", self._rs_name
+            )
+            if (
+                os.path.isfile(local_path)
+                or remote_paths[(subj, sess)] in self._remote_available
+            ):
+                avail_list.append((subj, sess))
+            else:
+                print(f"No res4d file detected for : {subj}, {sess}")
+        return avail_list
+
+    def _rs_rel_path(self, subj: str, sess: str) -> str:
+        """Return path to cleaned resting data within model_fsl."""
+        return os.path.join(
+            subj,
+            sess,
+            "func/run-01_level-first_name-rest.feat",
+            f"stats/{self._rs_name}",
+        )
 
-    @property
-    def _keoki_rs_path(self) -> Union[str, os.PathLike]:
+    def _keoki_rs_path(self, subj: str, sess: str) -> Union[str, os.PathLike]:
         """Return path to cleaned resting data on Keoki."""
         return os.path.join(
             self.keoki_deriv,
             "model_fsl",
-            self._subj,
-            self._sess,
-            "func/run-01_level-first_name-rest.feat",
-            f"stats/{self._rs_name}",
+            self._rs_rel_path(subj, sess),
         )
 
     def ul_rest(self, subj: str, sess: str):
-        """Clean intermediates and upload relevant files to Keoki."""
+        """Upload dot product output to Keoki, skipping intermediates."""
         src = os.path.join(self._work_deriv, subj, sess)
-        self._clean_subj(src)
-        dst_path = f"{self.keoki_deriv}/classify_rest/{subj}"
-        dst = f"{self._user}@{self.labarserv2_ip}:{dst_path}"
+        dst_path = f"{self.keoki_deriv}/classify_rest/{subj}/{sess}"
+        dst = f"{self._src_prefix}{dst_path}"
         self._make_dst(dst_path)
-        _, _ = self._submit_rsync(src, dst)
+        _, _ = self._submit_rsync(
+            f"{src}/", f"{dst}/", include="df_dot-product*"
+        )
 
     def _clean_subj(self, sub_dir: Union[str, os.PathLike]):
-        """Clean intermediates for subject."""
-        all_files = []
-        for path, subdir, files in os.walk(sub_dir):
-            for name in files:
-                all_files.append(os.path.join(path, name))
-        for file_path in all_files:
-            if "df_dot-product" not in file_path:
-                os.remove(file_path)
+        """Clean intermediates and intermediate-only dirs for subject."""
+        _, _ = self._submit(
+            ["find", sub_dir, "-mindepth", "1"]
+            + ["(", "-type", "f", "!", "-name", "df_dot-product*"]
+            + ["-delete", ")", "-o"]
+            + ["(", "-type", "d", "-empty", "-delete", ")"]
+        )
 
     def _make_dst(self, dst: Union[str, os.PathLike]):
         """Make output destination on Keoki."""
-        make_dst = f"""\
-            ssh \
-                -i {os.environ["RSA_LS2"]} \
-                {self._user}@{self.labarserv2_ip} \
-                " command ; bash -c 'mkdir -p {dst}'"
-        """
-        _, _ = submit.submit_subprocess(make_dst)
+        _, _ = self._submit(
+            self._ssh_argv
+            + [
+                f"{self._user}@{self.labarserv2_ip}",
+                f"command ; bash -c 'mkdir -p {dst}'",
+            ]
+        )
 
-    def clean_work(self, subj: str, sess: str):
-        """Remove file tree."""
+    def clean_work(self, subj: str, sess: str, keep_output: bool = False):
+        """Remove file tree, or only intermediates when keep_output."""
         rm_path = os.path.join(self._work_deriv, subj, sess)
-        _, _ = submit.submit_subprocess(f"rm -r {rm_path}")
+        self._forget_paths(rm_path)
+        if keep_output:
+            self._clean_subj(rm_path)
+            return
+        shutil.rmtree(rm_path, ignore_errors=True)
+
+
+@contextmanager
+def file_lock(file_path: Union[str, os.PathLike]):
+    """Hold exclusive lock on file_path.lock."""
+    with open(f"{file_path}.lock", "w") as lf:
+        fcntl.flock(lf, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lf, fcntl.LOCK_UN)
+
+
+def _stop_master(ctl_path: str, host: str):
+    """Stop ssh control master listening on ctl_path, if running."""
+    if not os.path.exists(ctl_path):
+        return
+    from classify_rest import submit
+
+    _, _ = submit.submit_subprocess(
+        ["ssh", "-o", f"ControlPath={ctl_path}", "-O", "exit", host]
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def _dl_gm_mask_cached(
+    proj_name: str, work_deriv: Union[str, os.PathLike], mask_name: str
+) -> Union[str, os.PathLike]:
+    """Download mask once per process, return file path."""
+    return DataSync(proj_name, work_deriv)._get_gm_mask(mask_name)
+
+
+@functools.lru_cache(maxsize=None)
+def _dl_class_weight_cached(
+    proj_name: str,
+    work_deriv: Union[str, os.PathLike],
+    model_name: str,
+    task_name: str,
+    con_name: str,
+) -> Union[str, os.PathLike]:
+    """Download classifier weights once per process, return file path."""
+    return DataSync(proj_name, work_deriv)._get_class_weight(
+        model_name, task_name, con_name
+    )
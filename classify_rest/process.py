@@ -1,272 +1,277 @@
 """Methods for processing data.
 
-zscore_vols : generate individual z-scored NIfTIs for each volume
+mask_vols : extract mask voxels of each cleaned resting state volume
+zscore_vols : z-score masked voxels of each cleaned resting state volume
+load_weight_arr : stack masked classifier weight maps, cached on disk
+clear_weight_cache : remove weight matrices cached by load_weight_arr
 DoDot : compute dot product between classifier weight matrix and
         cleaned resting state volumes.
 
 """
 
 import os
-import glob
-import time
+import hashlib
+import tempfile
+import functools
 from typing import Union
-from multiprocessing import Process
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
 import nibabel as nib
-from classify_rest import helper
-from classify_rest import submit
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 
 # %%
-def _clean_afni_stdout(
-    in_file: Union[str, os.PathLike], out_file: Union[str, os.PathLike]
-):
-    """Clean in_file of singularity verbiage, write out_file."""
-    sing_list = ["Container", "Executing"]
-    with open(in_file) as in_f, open(out_file, "w") as out_f:
-        for line in in_f:
-            if not any(x in line for x in sing_list):
-                out_f.write(line)
-
-
-def _read_line(in_file: Union[str, os.PathLike]) -> str:
-    """Return line value of in_file."""
-    with open(in_file, "r") as in_f:
-        line_val = in_f.readline()
-    if not line_val:
-        raise ValueError(f"Empty file : {in_file}")
-    return line_val
+@functools.lru_cache(maxsize=None)
+def _load_mask(mask_path: Union[str, os.PathLike]) -> tuple:
+    """Return index arrays of mask voxels, read once per mask_path.
 
+    Boolean indexing recomputes nonzero on every use, the index
+    arrays are computed once and reused for every map and volume.
+    The mask is compared in its on-disk dtype, avoiding a float64
+    copy from get_fdata.
 
-# %%
-class _CalcZscore:
-    """Calculate and generate z-scored NIfTI for single volume.
+    """
+    mask_img = nib.load(mask_path)
+    mask_idx = np.nonzero(np.asanyarray(mask_img.dataobj) != 0)
+    for idx in mask_idx:
+        idx.flags.writeable = False
+    return mask_idx
 
-    Wrapped (indirectly via submit.sched_zscore) by zscore_vols.
 
-    Methods
-    -------
-    zscore()
-        Conduct calculation and file generation
+def mask_vols(
+    res_path: Union[str, os.PathLike],
+    mask_path: Union[str, os.PathLike],
+    chunk_vols: int = 32,
+) -> np.ndarray:
+    """Return (num_vox, num_vols) values of rest EPI within mask.
 
-    """
+    Volumes are read chunk_vols at a time in their on-disk dtype and
+    masked before the float32 cast, so only one slab of the 4D image
+    is ever decompressed and held at once. The file is kept open
+    between slabs so gzipped data are decompressed in a single
+    forward pass.
 
-    def __init__(
-        self,
-        subj_deriv: Union[str, os.PathLike],
-        res_path: Union[str, os.PathLike],
-        mask_path: Union[str, os.PathLike],
-    ):
-        """Initialize."""
-        self._subj_deriv = subj_deriv
-        self._res_path = res_path
-        self._mask_path = mask_path
-        self._vol = int(os.environ["SLURM_ARRAY_TASK_ID"])
+    """
+    mask_idx = _load_mask(mask_path)
+    res_img = nib.load(res_path, mmap=True, keep_file_open=True)
+    num_vols = res_img.shape[-1]
+    res_vox = np.empty((mask_idx[0].size, num_vols), dtype=np.float32)
+    for vol_start in range(0, num_vols, chunk_vols):
+        vol_end = min(vol_start + chunk_vols, num_vols)
+        res_slab = res_img.dataobj[..., vol_start:vol_end]
+        res_vox[:, vol_start:vol_end] = res_slab[mask_idx]
+    return res_vox
 
-    def zscore(self):
-        """Compute z-score for volume."""
-        # Check for previous work
-        out_path = os.path.join(
-            self._subj_deriv, f"tmp_vol-{self._vol}_zscore.nii.gz"
-        )
-        if os.path.exists(out_path):
-            return
-
-        # Calculate mean, std, check for values
-        vol_mean = self._mean()
-        vol_std = self._std()
-        if not vol_mean or not vol_std:
-            raise ValueError("Error calculating mean, std")
-
-        # Calculate zscore
-        cmd_list = [
-            "3dcalc",
-            f"-a '{self._res_path}[{self._vol}]'",
-            f"-expr '(a-{vol_mean})/{vol_std}'",
-            f"-prefix {out_path}",
-        ]
-        bash_cmd = " ".join(self._prepend_afni() + cmd_list)
-        submit.submit_subprocess(bash_cmd)
-        if not os.path.exists(out_path):
-            raise FileNotFoundError(f"Missing file : {out_path}")
-
-    def _mean(self) -> str:
-        """Compute mean of volume."""
-        out_txt = os.path.join(self._subj_deriv, f"tmp_mean_{self._vol}.txt")
-        cmd_list = [
-            "3dBrickStat",
-            f"-mask {self._mask_path}",
-            f"-mean '{self._res_path}[{self._vol}]'",
-            f"> {out_txt}",
-        ]
-        return self._submit_read(cmd_list, out_txt)
-
-    def _std(self) -> str:
-        """Compute stdev of volume."""
-        out_txt = os.path.join(self._subj_deriv, f"tmp_std_{self._vol}.txt")
-        cmd_list = [
-            "3dBrickStat",
-            f"-mask {self._mask_path}",
-            f"-stdev '{self._res_path}[{self._vol}]'",
-            f"> {out_txt}",
-        ]
-        return self._submit_read(cmd_list, out_txt)
-
-    def _submit_read(self, cmd_list, out_txt) -> str:
-        """Run bash command and extract AFNI stdout."""
-        bash_cmd = " ".join(self._prepend_afni() + cmd_list)
-        submit.submit_subprocess(bash_cmd)
-        time.sleep(3)  # wait for singularity to close
-        out_csv = out_txt.replace(".txt", ".csv")
-        _clean_afni_stdout(out_txt, out_csv)
-        return _read_line(out_csv)
-
-    def _prepend_afni(self) -> list:
-        """Return singularity call setup."""
-        par_dir = os.path.dirname(self._mask_path)
-        return [
-            "singularity",
-            "run",
-            "--cleanenv",
-            f"--bind {par_dir}:{par_dir}",
-            f"--bind {self._subj_deriv}:{self._subj_deriv}",
-            f"--bind {self._subj_deriv}:/opt/home",
-            os.environ["SING_AFNI"],
-        ]
 
+def zscore_vols(res_vox: np.ndarray) -> np.ndarray:
+    """Z-score each volume of rest EPI within mask.
 
-# %%
-def zscore_vols(res_path, mask_path, subj_deriv, log_dir):
-    """Convert each volume of rest EPI to z-scored NIfTI.
+    Volume mean and standard deviation are computed from, and the
+    z-score is applied to, the voxels within mask in a single
+    vectorized pass.
 
     Parameters
     ----------
-    res_path : str, os.PathLike
-        Location of cleaned resting state EPI
-    mask_path : str, os.PathLike
-        Location of binary mask
-    subj_deriv : str, os.PathLike
-        Output location for subject
-    log_dir : str, os.PathLike
-        Output location for logs
+    res_vox : np.ndarray, process.mask_vols
+        (num_vox, num_vols) values of mask voxels
 
     Returns
     -------
-    dict
-        {0: "/path/to/tmp_vol-0_zscore.nii.gz"}
-        Volume number and path to file
+    np.ndarray
+        (num_vox, num_vols) z-scored values of mask voxels
 
     """
-    # Conduct z-scoring of volumes
-    img = nib.load(res_path)
-    num_vols = img.header.get_data_shape()[-1]
-    submit.sched_zscore(
-        num_vols,
-        res_path,
-        subj_deriv,
-        mask_path,
-        log_dir,
-    )
-
-    # Build out dict manually to ensure order
-    res_vols = {}
-    for vol in list(range(0, num_vols)):
-        res_path = os.path.join(subj_deriv, f"tmp_vol-{vol}_zscore.nii.gz")
-        if os.path.exists(res_path):
-            res_vols[vol] = res_path
-
-    # Check for all expected output
-    if len(res_vols.keys()) != num_vols:
-        raise ValueError("Failure in zscore volume extraction.")
-    return res_vols
-
-
-# %%
-def _calc_dot(
-    res_vols: dict,
-    emo_name: str,
-    weight_path: Union[str, os.PathLike],
+    vol_mean = res_vox.mean(axis=0)
+    vol_std = res_vox.std(axis=0, ddof=0)
+    if not np.all(np.isfinite(vol_mean)) or not np.all(vol_std > 0):
+        raise ValueError("Error calculating mean, std")
+    return (res_vox - vol_mean) / vol_std
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _zdot(res_vox, weight_arr, out, block_bytes=262144, num_tiles=1):
+        """Fused z-score and dot product, without a z-score temporary.
+
+        Volume statistics are accumulated serially and row-wise over
+        (num_vox, num_vols) res_vox so inner loops are unit-stride.
+        Volumes are then split into num_tiles tiles, one per thread,
+        which fill disjoint columns of (num_emo, num_vols) out in
+        parallel. Each tile keeps its own accumulator and walks voxels
+        in blocks sized so a (block, tile) slab of res_vox fits in
+        block_bytes (~L2), which every emotion row then reuses from
+        cache. num_tiles is passed in rather than read from numba so
+        the kernel stays cacheable.
+
+        """
+        num_vox, num_vols = res_vox.shape
+        num_emo = weight_arr.shape[0]
+        vol_mean = np.zeros(num_vols)
+        for v in range(num_vox):
+            for t in range(num_vols):
+                vol_mean[t] += res_vox[v, t]
+        vol_mean /= num_vox
+        sum_sq = np.zeros(num_vols)
+        for v in range(num_vox):
+            for t in range(num_vols):
+                diff = res_vox[v, t] - vol_mean[t]
+                sum_sq[t] += diff * diff
+        vol_std = np.sqrt(sum_sq / num_vox)
+        for t in range(num_vols):
+            if not vol_std[t] > 0:
+                raise ValueError("Error calculating mean, std")
+
+        tile = -(-num_vols // max(1, min(num_vols, num_tiles)))
+        num_tiles = -(-num_vols // tile)
+        block = max(1, block_bytes // (tile * res_vox.itemsize))
+        for k in numba.prange(num_tiles):
+            t_start = k * tile
+            t_end = min(t_start + tile, num_vols)
+            acc = np.zeros((num_emo, t_end - t_start))
+            for vox_start in range(0, num_vox, block):
+                vox_end = min(vox_start + block, num_vox)
+                for m in range(num_emo):
+                    for v in range(vox_start, vox_end):
+                        weight = weight_arr[m, v]
+                        if weight == 0:
+                            continue
+                        for t in range(t_start, t_end):
+                            acc[m, t - t_start] += weight * (
+                                res_vox[v, t] - vol_mean[t]
+                            )
+            for m in range(num_emo):
+                for t in range(t_start, t_end):
+                    out[m, t] = acc[m, t - t_start] / vol_std[t]
+
+
+def _build_weight_arr(
+    weight_maps: list,
     mask_path: Union[str, os.PathLike],
-    subj_deriv: Union[str, os.PathLike],
     mask_sig: bool,
-):
-    """Calculate dot products.
+) -> np.ndarray:
+    """Read and stack masked weight maps.
 
-    Writes a tmp_emo*_weight.csv to subject output directory. Wrapped
-    (indirectly via submit.sched_dotprod) by DoDot.
+    Nibabel releases the GIL while decompressing, so maps are read in
+    threads. When mask_sig, weights outside each emotion's significant
+    voxels are zeroed.
 
     """
-    # Start empty output file
-    par_dir = os.path.dirname(mask_path)
-    out_txt = os.path.join(subj_deriv, f"tmp_df_{emo_name}_weight.txt")
-    open(out_txt, "w").close()
-
-    def _prepend_afni() -> list:
-        """Return singularity call setup."""
-        return [
-            "singularity",
-            "run",
-            "--cleanenv",
-            f"--bind {par_dir}:{par_dir}",
-            f"--bind {subj_deriv}:{subj_deriv}",
-            f"--bind {subj_deriv}:/opt/home",
-            os.environ["SING_AFNI"],
-        ]
-
-    def _mult_mask() -> Union[str, os.PathLike]:
-        """Multiple binary mask with ROI."""
-        # Find binary mask, check for previous work
-        bin_path = weight_path.replace("importance", "binary")
-        if not os.path.exists(bin_path):
-            raise FileNotFoundError(f"Expected binary mask : {bin_path}")
-        bin_out = os.path.join(
-            subj_deriv, "tmp_mlt-" + os.path.basename(bin_path)
-        )
-        if os.path.exists(bin_out):
-            return bin_out
-
-        # Conduct mask * binary mult
-        mult_list = [
-            "3dcalc",
-            f"-a {mask_path}",
-            f"-b {bin_path}",
-            f"-prefix {bin_out}",
-            "-expr 'a*step(b)'",
-        ]
-        bash_cmd = " ".join(_prepend_afni() + mult_list)
-        submit.submit_subprocess(bash_cmd)
-
-        # Check for output
-        time.sleep(3)  # wait for singularity to close
-        if not os.path.exists(bin_out):
-            raise FileNotFoundError(
-                f"Missing ROI-binary intersection mask : {bin_out}"
-            )
-        return bin_out
+    mask_idx = _load_mask(mask_path)
+
+    def _read_masked(file_path: Union[str, os.PathLike]) -> np.ndarray:
+        """Return values of file_path within mask."""
+        file_img = nib.load(file_path, mmap=True)
+        return np.asanyarray(file_img.dataobj)[mask_idx].astype(np.float32)
+
+    bin_maps = [x.replace("importance", "binary") for x in weight_maps]
+    with ThreadPoolExecutor(max_workers=len(weight_maps)) as executor:
+        weight_arr = np.stack(list(executor.map(_read_masked, weight_maps)))
+        if mask_sig:
+            for idx, sig_vox in enumerate(
+                executor.map(_read_masked, bin_maps)
+            ):
+                weight_arr[idx, sig_vox <= 0] = 0
+    return weight_arr
+
+
+def load_weight_arr(
+    weight_maps: list,
+    mask_path: Union[str, os.PathLike],
+    mask_sig: bool,
+) -> np.ndarray:
+    """Return (num_emo, num_vox) masked weights, cached across jobs.
+
+    The stacked weights are identical for every subject of a setup, so
+    are saved once as weight_arr_<hash>.npy next to the weight maps and
+    memory-mapped by later calls. The hash covers the map and mask
+    paths, their modification times, and mask_sig, so regenerated
+    maps produce a new cache file; stale files are removed by
+    clear_weight_cache, called when wf_setup rebuilds maps. The
+    cache file is written to a hidden .tmp-weight_arr_* name and
+    renamed, so concurrent jobs never read a partial file.
 
-    # Multiply ROI (template GM) mask by binary classifier mask
-    mask_path = _mult_mask() if mask_sig else mask_path
+    Parameters
+    ----------
+    weight_maps : list
+        Locations of importance weight maps, one per emotion
+    mask_path : str, os.PathLike
+        Location of binary mask
+    mask_sig : bool
+        Whether to zero weights outside significant voxels
 
-    # Calc dot product for each volume
-    for vol, res_path in res_vols.items():
-        print(f"Calculating dot product for volume : {vol}")
-        dot_list = [
-            "3ddot",
-            f"-mask {mask_path}",
-            f"-dodot {res_path} {weight_path}",
-            f">> {out_txt}",
-        ]
-        bash_cmd = " ".join(_prepend_afni() + dot_list)
-        submit.submit_subprocess(bash_cmd)
+    Returns
+    -------
+    np.ndarray
+        (num_emo, num_vox) float32 weights, read-only
 
-    # Clean txt file of singularity verbiage, write csv
-    out_csv = out_txt.replace(".txt", ".csv")
-    _clean_afni_stdout(out_txt, out_csv)
+    Raises
+    ------
+    FileNotFoundError
+        Missing binary mask when mask_sig
 
-    # Check line number of cleaned csv
-    num_lines = sum(1 for _ in open(out_csv))
-    if num_lines != len(res_vols):
-        raise ValueError(f"Did not find {len(res_vols)} lines in : {out_csv}")
+    """
+    # Check for binary masks before doing any reads
+    chk_list = [mask_path] + list(weight_maps)
+    if mask_sig:
+        bin_maps = [x.replace("importance", "binary") for x in weight_maps]
+        for bin_path in bin_maps:
+            if not os.path.exists(bin_path):
+                raise FileNotFoundError(f"Expected binary mask : {bin_path}")
+        chk_list += bin_maps
+
+    # Load existing cache
+    key = repr(
+        ([(x, os.stat(x).st_mtime_ns) for x in chk_list], bool(mask_sig))
+    )
+    cache_path = os.path.join(
+        os.path.dirname(weight_maps[0]),
+        f"weight_arr_{hashlib.sha1(key.encode()).hexdigest()[:16]}.npy",
+    )
+    try:
+        return np.load(cache_path, mmap_mode="r")
+    except FileNotFoundError:
+        pass
+
+    # Build and save atomically, concurrent jobs may race to write
+    weight_arr = _build_weight_arr(weight_maps, mask_path, mask_sig)
+    with tempfile.NamedTemporaryFile(
+        dir=os.path.dirname(cache_path),
+        prefix=".tmp-weight_arr_",
+        suffix=".npy",
+        delete=False,
+    ) as tf:
+        try:
+            np.save(tf, weight_arr)
+        except BaseException:
+            os.unlink(tf.name)
+            raise
+    os.replace(tf.name, cache_path)
+    weight_arr.flags.writeable = False
+    return weight_arr
+
+
+def clear_weight_cache(cache_dir: Union[str, os.PathLike]):
+    """Remove weight_arr_*.npy files written by load_weight_arr.
+
+    Temporary .tmp-weight_arr_* files are skipped, since they may
+    belong to a write in progress in another job.
+
+    """
+    with os.scandir(cache_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if not (name.startswith("weight_arr_") and name.endswith(".npy")):
+                continue
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
 
 
 # %%
@@ -275,20 +280,17 @@ class DoDot:
 
     Compute dot product calculations between all emotion
     classifier weight matrices and each volume of cleaned
-    resting state EPI.
-
-    Write output to subject derivatives location, and determine
-    label for each volume (maximum product).
+    resting state EPI, and determine label for each volume
+    (maximum product).
 
     Parameters
     ----------
-    res_vols : dict, process.zscore_vols
-        {0: "/path/to/tmp_vol-0_zscore.nii.gz"}
-        Volume number and path to file
-    mask_path : str, os.PathLike
-        Location of binary mask
+    res_vox : np.ndarray, process.mask_vols
+        (num_vox, num_vols) values of mask voxels
     subj_deriv : str, os.PathLike
         Output location for subject
+    mask_path : str, os.PathLike
+        Location of binary mask
 
     Attributes
     ----------
@@ -298,8 +300,7 @@ class DoDot:
     Methods
     -------
     calc_dot()
-        Calculate the dot products of each volume by emotion,
-        in parallel
+        Calculate the dot products of each volume by emotion
     label_vol()
         Assign label for each volume from dot product ouput
 
@@ -312,71 +313,58 @@ class DoDot:
 
     """
 
-    def __init__(self, res_vols, subj_deriv, mask_path):
+    def __init__(self, res_vox, subj_deriv, mask_path):
         """Initialize."""
-        helper.check_afni()
-        self._res_vols = res_vols
+        self._res_vox = res_vox
         self._mask_path = mask_path
         self._subj_deriv = subj_deriv
 
-    def calc_dot(
-        self,
-        weight_maps: list,
-        log_dir: Union[str, os.PathLike],
-        mask_sig: bool,
-    ):
-        """Compute dot product of each weight map in parallel."""
+    def calc_dot(self, weight_maps: list, mask_sig: bool):
+        """Compute dot product of all weight maps and volumes at once.
+
+        Masked weight maps are stacked into an (emotion x voxel)
+        matrix (see load_weight_arr) and multiplied by the (voxel x
+        volume) z-scores in a single GEMM. When mask_sig, weights
+        outside each emotion's significant voxels are zeroed, which is
+        equivalent to masking the volumes per-emotion.
+
+        When numba is installed the z-score is fused into the product
+        kernel, otherwise volumes are z-scored via zscore_vols first.
+
+        """
 
         def _emo_name(weight_path: Union[str, os.PathLike]) -> str:
             """Return emotion name."""
             return os.path.basename(weight_path).split("emo-")[1].split("_")[0]
 
-        # Run emotions in parallel
-        mult_proc = [
-            Process(
-                target=submit.sched_dotprod,
-                args=(
-                    self._res_vols,
-                    _emo_name(weight_path),
-                    self._mask_path,
-                    weight_path,
-                    self._subj_deriv,
-                    log_dir,
-                    mask_sig,
-                ),
-            )
-            for weight_path in weight_maps
-        ]
-        for proc in mult_proc:
-            proc.start()
-        for proc in mult_proc:
-            proc.join()
-        print("Done : process.DoDot.parallel_dot", flush=True)
+        # Get (emotion x voxel) weights, restricted to significant voxels
+        weight_arr = load_weight_arr(weight_maps, self._mask_path, mask_sig)
 
-    def label_vol(self):
-        """Aggregate emotion dataframes and assign volume labels."""
-        csv_list = sorted(glob.glob(f"{self._subj_deriv}/tmp_df_*csv"))
-        if not csv_list:
-            raise FileNotFoundError(
-                f"Expected csv files in {self._subj_deriv}"
+        # Compute (emotion x volume) products, organize as dataframe
+        if numba is not None:
+            prod = np.empty(
+                (weight_arr.shape[0], self._res_vox.shape[1]),
+                dtype=np.float32,
             )
-
-        # Aggregate emotion dataframes
+            _zdot(
+                np.ascontiguousarray(self._res_vox),
+                weight_arr,
+                prod,
+                num_tiles=numba.get_num_threads(),
+            )
+            if not np.all(np.isfinite(prod)):
+                raise ValueError("Error calculating mean, std")
+        else:
+            prod = weight_arr @ zscore_vols(self._res_vox)
         self.df_prod = pd.DataFrame(
-            data={"volume": list(range(1, len(self._res_vols.keys()) + 1))}
+            prod.T, columns=[f"emo_{_emo_name(x)}" for x in weight_maps]
         )
-        for csv_path in csv_list:
-            _tmp, _df, emo_name, _suff = os.path.basename(csv_path).split("_")
-            df = pd.read_csv(csv_path, header=None, names=[f"emo_{emo_name}"])
-            df.index += 1
-            df = df.reset_index().rename(columns={"index": "volume"})
-            self.df_prod = self.df_prod.merge(df, how="left", on="volume")
-
-        # Assign volume labels
-        emo_cols = [x for x in self.df_prod.columns if x != "volume"]
-        self.df_prod["label_max"] = self.df_prod[emo_cols].idxmax(axis=1)
-        self.df_prod["label_max"] = self.df_prod["label_max"].str.replace(
-            "emo_", ""
-        )
-        for csv_file in csv_list:
-            os.remove(csv_file)
+        self.df_prod.insert(0, "volume", np.arange(1, prod.shape[1] + 1))
+        print("Done : process.DoDot.calc_dot", flush=True)
+
+    def label_vol(self):
+        """Assign volume labels from dot product output."""
+        emo_cols = [x for x in self.df_prod.columns if x.startswith("emo_")]
+        emo_names = np.array([x[4:] for x in emo_cols])
+        max_idx = self.df_prod[emo_cols].to_numpy().argmax(axis=1)
+        self.df_prod["label_max"] = emo_names[max_idx]
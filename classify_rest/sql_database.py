@@ -1,13 +1,22 @@
 """Methods for sending data to mysql database db_emorep.
 
 DbConnect : connect to and interact with db_emorep on mysql server
+prime_db_check : cache existing keys of db_emorep.tbl_dotprod_*
 db_check : check for existing data in db_emorep.tbl_dotprod_*
+DbBatchWriter : batch inserts into db_emorep.tbl_dotprod_*
 db_update : update db_emorep.tbl_dotprod_*
+get_sess_names : determine session task names for many subjects
+get_sess_name : determine session task name
+get_rest_subjs : list subjects having rest ratings
+close_db : close connection shared by module functions
 
 """
 
 import os
-from typing import Type
+import atexit
+import functools
+import itertools
+from typing import Tuple, Type
 from contextlib import contextmanager
 import pandas as pd
 import pymysql
@@ -15,6 +24,12 @@ import paramiko
 from sshtunnel import SSHTunnelForwarder
 
 
+@functools.lru_cache(maxsize=4)
+def _load_rsa(rsa_path: str, mtime: float) -> paramiko.RSAKey:
+    """Return parsed RSA key, cached on path and modification time."""
+    return paramiko.RSAKey.from_private_key_file(rsa_path)
+
+
 class DbConnect:
     """Supply db_emorep database connection and interaction methods.
 
@@ -78,9 +93,8 @@ class DbConnect:
 
     def _connect_ssh(self):
         """Start ssh tunnel."""
-        rsa_keoki = paramiko.RSAKey.from_private_key_file(
-            os.environ["RSA_LS2"]
-        )
+        rsa_path = os.environ["RSA_LS2"]
+        rsa_keoki = _load_rsa(rsa_path, os.stat(rsa_path).st_mtime)
         self._ssh_tunnel = SSHTunnelForwarder(
             ("ccn-labarserv2.vm.duke.edu", 22),
             ssh_username=os.environ["USER"],
@@ -201,28 +215,77 @@ class _KeyMap:
         """Return fsl_con_id"""
         return self._ref_con[con]
 
-    def emo_label(self, row, row_name) -> int:
-        """Update column values with emo_id."""
-        for emo_name, emo_id in self._ref_emo.items():
-            if row[row_name] == emo_name:
-                return emo_id
+    def emo_map(self, emo_col: pd.Series) -> pd.Series:
+        """Return emo_id for each emotion name in emo_col."""
+        emo_id = emo_col.map(self._ref_emo)
+        if emo_id.isna().any():
+            unknown = sorted(set(emo_col[emo_id.isna()]))
+            raise KeyError(f"Emotions missing from ref_emo : {unknown}")
+        return emo_id.astype("int64")
+
+
+@functools.lru_cache(maxsize=1)
+def _shared_db() -> Tuple[DbConnect, _KeyMap]:
+    """Return connection and key map shared by module functions.
+
+    A single ssh tunnel and mysql login serve db_check, db_update,
+    and get_sess_name within a process, see close_db.
+
+    """
+    db_con = DbConnect()
+    return (db_con, _KeyMap(db_con))
+
+
+@atexit.register
+def close_db():
+    """Close shared connection, if one was opened."""
+    if _shared_db.cache_info().currsize:
+        db_con, _ = _shared_db()
+        _shared_db.cache_clear()
+        db_con.close_con()
+
+
+# Existing (subj_id, sess_id, fsl_task_id) per tbl_dotprod_<proj_name>,
+# populated by prime_db_check
+_DB_CHECK_CACHE = {}
+
+
+def prime_db_check(proj_name: str):
+    """Cache existing tbl_dotprod_* subj, sess, task keys in one query.
+
+    Subsequent db_check calls for proj_name are answered from the
+    cache rather than querying db_emorep per subject session.
+
+    """
+    db_con, _ = _shared_db()
+    sql_cmd = (
+        "select distinct subj_id, sess_id, fsl_task_id "
+        + f"from tbl_dotprod_{proj_name}"
+    )
+    _DB_CHECK_CACHE[proj_name] = set(db_con.fetch_rows(sql_cmd))
 
 
 def db_check(subj: str, sess: str, proj_name: str, task_name: str) -> bool:
-    """Check if tbl_dotprod already has subj, sess, task data."""
+    """Check if tbl_dotprod already has subj, sess, task data.
+
+    Uses the cache from prime_db_check when available, otherwise
+    queries db_emorep.
+
+    """
     # Validate task_name
     if task_name not in ["movies", "scenarios", "both"]:
         raise ValueError(f"Unexpected task_name : {task_name}")
 
-    # Connect, get helper
-    db_con = DbConnect()
-    km = _KeyMap(db_con)
+    # Get connection, helper
+    db_con, km = _shared_db()
 
     # Check if data exists in db_emorep.tbl_dotprod_*
     # TODO add support for checking fsl_con_id, fsl_model_id, mask_id
     subj_id = km.subj_map(subj, proj_name)
     sess_id = km.sess_map(sess)
     fsl_task_id = km.fsl_task_map(task_name)
+    if proj_name in _DB_CHECK_CACHE:
+        return (subj_id, sess_id, fsl_task_id) in _DB_CHECK_CACHE[proj_name]
     sql_cmd = (
         f"select * from tbl_dotprod_{proj_name} "
         + f"where subj_id={subj_id} and sess_id={sess_id} "
@@ -230,10 +293,139 @@ def db_check(subj: str, sess: str, proj_name: str, task_name: str) -> bool:
         + "limit 1"
     )
     rows = db_con.fetch_rows(sql_cmd)
-    db_con.close_con()
     return True if rows else False
 
 
+# Insert statement and column list per tbl_dotprod_<proj_name>, the
+# table schema is static so query information_schema once per process
+_INSERT_TEMPLATE = {}
+
+
+def _insert_template(
+    proj_name: str, db_con: Type[DbConnect]
+) -> Tuple[str, list]:
+    """Return insert statement and column list for tbl_dotprod_*."""
+    if proj_name in _INSERT_TEMPLATE:
+        return _INSERT_TEMPLATE[proj_name]
+
+    sql_cmd = (
+        "select column_name from information_schema.columns "
+        + "where table_schema='db_emorep' "
+        + f"and table_name='tbl_dotprod_{proj_name}'"
+    )
+    col_list = [x[0] for x in db_con.fetch_rows(sql_cmd)]
+    val_list = ["%s" for x in col_list]
+    sql_cmd = (
+        f"insert ignore into tbl_dotprod_{proj_name} "
+        + f"({', '.join(col_list)}) "
+        + f"values ({', '.join(val_list)})"
+    )
+    _INSERT_TEMPLATE[proj_name] = (sql_cmd, col_list)
+    return _INSERT_TEMPLATE[proj_name]
+
+
+class DbBatchWriter:
+    """Batch rows into db_emorep.tbl_dotprod_* over one connection.
+
+    Uses the connection shared by module functions, gets the insert
+    statement once, and writes accumulated rows via executemany every
+    flush_rows rows and on exit. Call close_db when done.
+
+    Parameters
+    ----------
+    proj_name : str
+        {"emorep", "archival"}
+        Project name, selects tbl_dotprod_<proj_name>
+    flush_rows : int, optional
+        Number of rows to accumulate before writing
+
+    Methods
+    -------
+    add(*args)
+        Format dot product dataframe and queue rows for insert
+    flush()
+        Write queued rows to db_emorep
+
+    Example
+    -------
+    with sql_database.DbBatchWriter("emorep") as writer:
+        for subj, sess, df in jobs:
+            writer.add(df, subj, sess, *args)
+    sql_database.close_db()
+
+    """
+
+    def __init__(self, proj_name: str, flush_rows: int = 10000):
+        """Initialize."""
+        self._proj_name = proj_name
+        self._flush_rows = flush_rows
+        self._rows = []
+
+    def __enter__(self):
+        """Get connection and insert statement."""
+        self._db_con, self._km = _shared_db()
+        self._sql_cmd, self._col_list = _insert_template(
+            self._proj_name, self._db_con
+        )
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Write remaining rows unless exiting on error."""
+        if exc_type is None:
+            self.flush()
+
+    def add(
+        self,
+        df: pd.DataFrame,
+        subj: str,
+        sess: str,
+        mask_name: str,
+        model_name: str,
+        task_name: str,
+        con_name: str,
+        mask_sig: bool,
+    ):
+        """Make df compliant with db_emorep, queue rows for insert.
+
+        Foreign keys are constant for the session and are repeated
+        into each row rather than added to df, and df is not modified.
+
+        """
+        # Get foreign key values, replace alpha emo with key value
+        col_values = {
+            "subj_id": self._km.subj_map(subj, self._proj_name),
+            "sess_id": self._km.sess_map(sess),
+            "fsl_task_id": self._km.fsl_task_map(task_name),
+            "fsl_model_id": self._km.fsl_model_map(model_name),
+            "fsl_con_id": self._km.fsl_con_map(con_name),
+            "mask_id": self._km.mask_map(mask_name, mask_sig),
+        }
+        col_values = {
+            x: itertools.repeat(y, len(df)) for x, y in col_values.items()
+        }
+        col_values["label_max"] = self._km.emo_map(df["label_max"]).tolist()
+
+        # Queue input for execute many, tolist yields native python
+        # scalars which pymysql can escape (numpy scalars it cannot)
+        self._rows.extend(
+            zip(
+                *(
+                    col_values[x] if x in col_values else df[x].tolist()
+                    for x in self._col_list
+                )
+            )
+        )
+        if len(self._rows) >= self._flush_rows:
+            self.flush()
+
+    def flush(self):
+        """Write queued rows to db_emorep."""
+        if not self._rows:
+            return
+        self._db_con.exec_many(self._sql_cmd, self._rows)
+        self._rows = []
+
+
 def db_update(
     df: pd.DataFrame,
     subj: str,
@@ -244,52 +436,81 @@ def db_update(
     task_name: str,
     con_name: str,
     mask_sig: bool,
-) -> list:
-    """Make df compliant with db_emorep, return list of tuples."""
-    # Add foreign key columns
-    db_con = DbConnect()
-    km = _KeyMap(db_con)
-    df["subj_id"] = km.subj_map(subj, proj_name)
-    df["sess_id"] = km.sess_map(sess)
-    df["fsl_task_id"] = km.fsl_task_map(task_name)
-    df["fsl_model_id"] = km.fsl_model_map(model_name)
-    df["fsl_con_id"] = km.fsl_con_map(con_name)
-    df["mask_id"] = km.mask_map(mask_name, mask_sig)
-
-    # Replace alpha emo with key value
-    df["label_max"] = df.apply(lambda x: km.emo_label(x, "label_max"), axis=1)
-
-    # Generate input for execute many
-    sql_cmd = (
-        "select column_name from information_schema.columns "
-        + "where table_schema='db_emorep' "
-        + f"and table_name='tbl_dotprod_{proj_name}'"
-    )
-    rows = db_con.fetch_rows(sql_cmd)
-    col_list = [x[0] for x in rows]
-    val_list = ["%s" for x in col_list]
-    tbl_input = list(df[col_list].itertuples(index=False, name=None))
+):
+    """Update tbl_dotprod_* with df, df is not modified.
 
-    # Built sql_cmd, update db
+    Single-session wrapper of DbBatchWriter, use DbBatchWriter
+    directly to write many sessions over one connection.
+
+    """
+    with DbBatchWriter(proj_name) as writer:
+        writer.add(
+            df,
+            subj,
+            sess,
+            mask_name,
+            model_name,
+            task_name,
+            con_name,
+            mask_sig,
+        )
+
+
+def get_sess_names(subj_sess: list) -> dict:
+    """Determine session task names for many subjects in one query.
+
+    Parameters
+    ----------
+    subj_sess : list
+        Tuples of (subj, sess) BIDS identifiers
+
+    Returns
+    -------
+    dict
+        {(subj, sess): task_name}
+
+    """
+    # Map identifiers to db_emorep keys
+    db_con, km = _shared_db()
+    key_map = {
+        (km.subj_map(subj, "emorep"), km.sess_map(sess)): (subj, sess)
+        for subj, sess in subj_sess
+    }
+    if not key_map:
+        return {}
+
+    # Get session task names from db_emorep
+    key_list = ", ".join(f"({x}, {y})" for x, y in key_map)
     sql_cmd = (
-        f"insert ignore into tbl_dotprod_{proj_name} ({', '.join(col_list)}) "
-        + f"values ({', '.join(val_list)})"
+        "select a.subj_id, a.sess_id, b.task_name from ref_sess_task a "
+        + "join ref_task b on a.task_id = b.task_id "
+        + f"where (a.subj_id, a.sess_id) in ({key_list})"
     )
-    db_con.exec_many(sql_cmd, tbl_input)
-    db_con.close_con()
+    return {
+        key_map[(subj_id, sess_id)]: task
+        for subj_id, sess_id, task in db_con.fetch_rows(sql_cmd)
+    }
 
 
 def get_sess_name(subj: str, sess: str) -> str:
     """Determine session task name."""
-    # Get session task name from db_emorep
-    db_con = DbConnect()
-    km = _KeyMap(db_con)
+    task_map = get_sess_names([(subj, sess)])
+    if (subj, sess) not in task_map:
+        raise ValueError(f"No session task found for {subj}, {sess}")
+    return task_map[(subj, sess)]
+
+
+def get_rest_subjs() -> list:
+    """Return BIDS subject identifiers having rest ratings.
+
+    Uses the shared connection, so an array task that then runs
+    ClassRest logs in to db_emorep only once.
+
+    """
+    db_con, _ = _shared_db()
     sql_cmd = (
-        "select b.task_name from ref_sess_task a "
-        + "join ref_task b on a.task_id = b.task_id "
-        + f"where a.subj_id = {km.subj_map(subj, 'emorep')} "
-        + f"and a.sess_id = {km.sess_map(sess)}"
+        "select distinct subj_name from ref_subj a "
+        + "join tbl_rest_ratings b on a.subj_id=b.subj_id "
+        + "order by subj_name"
     )
-    rows = db_con.fetch_rows(sql_cmd)
-    db_con.close_con()
-    return rows[0][0]
+    return [f"sub-{x[0]}" for x in db_con.fetch_rows(sql_cmd)]
@@ -7,8 +7,12 @@ ClassRest : compute dot product for each volume x emotion
 
 # %%
 import os
-import glob
+import re
+import functools
+import threading
+from pathlib import Path
 from typing import Union
+from concurrent.futures import ThreadPoolExecutor
 from classify_rest import helper
 from classify_rest import process
 from classify_rest import sql_database
@@ -16,6 +20,27 @@ from func_model.resources import group
 
 
 # %%
+@functools.lru_cache(maxsize=None)
+def _find_weight_maps(
+    work_deriv: Union[str, os.PathLike],
+    model_name: str,
+    task_name: str,
+    con_name: str,
+) -> tuple:
+    """Return sorted importance map paths from one directory scan."""
+    map_re = re.compile(
+        re.escape(
+            f"importance_model-{model_name}_"
+            + f"task-{task_name}_con-{con_name}_emo-"
+        )
+        + r"[^_]+_map\.nii\.gz"
+    )
+    with os.scandir(work_deriv) as entries:
+        return tuple(
+            sorted(x.path for x in entries if map_re.fullmatch(x.name))
+        )
+
+
 def wf_setup(
     proj_name,
     work_deriv,
@@ -67,38 +92,55 @@ def wf_setup(
     mk_mask = group.ImportanceMask(mask_path)
     emo_list = mk_mask.emo_names()
 
-    def _build_mask(
-        class_name: str, mask_type: str
-    ) -> Union[str, os.PathLike]:
+    # Determine which masks to build, skip existing
+    class_list = (
+        ["movies", "scenarios"] if task_name == "match" else [task_name]
+    )
+    type_list = ["importance", "binary"] if mask_sig else ["importance"]
+    build_list = []
+    for emo_name in emo_list:
+        for class_name in class_list:
+            for mask_type in type_list:
+                out_path = os.path.join(
+                    work_deriv,
+                    f"{mask_type}_model-{model_name}_task-{class_name}_"
+                    + f"con-{con_name}_emo-{emo_name}_map.nii.gz",
+                )
+                if not os.path.exists(out_path):
+                    build_list.append((class_name, emo_name, mask_type))
+    if not build_list:
+        return
+
+    # Give each thread its own ImportanceMask to avoid sharing state
+    thread_mask = threading.local()
+
+    def _build_mask(build_args: tuple) -> Union[str, os.PathLike]:
         """Wrap mk_mask.sql_mask."""
-        out_path = os.path.join(
-            work_deriv,
-            f"{mask_type}_model-{model_name}_task-{class_name}_"
-            + f"con-{con_name}_emo-{emo_name}_map.nii.gz",
-        )
-        if os.path.exists(out_path):
-            return out_path
-        return mk_mask.sql_masks(
+        if not hasattr(thread_mask, "mk_mask"):
+            thread_mask.mk_mask = group.ImportanceMask(mask_path)
+        class_name, emo_name, mask_type = build_args
+        return thread_mask.mk_mask.sql_masks(
             class_name, model_name, con_name, emo_name, mask_type, work_deriv
         )
 
-    def _org_build(mask_type: str) -> Union[list, str, os.PathLike]:
-        """Determine which masks to build."""
-        if task_name == "match":
-            out_list = []
-            for class_name in ["movies", "scenarios"]:
-                out_list.append(_build_mask(class_name, mask_type))
-            return out_list
-        else:
-            return _build_mask(task_name, mask_type)
-
-    # Make masks for each emotion classifier
-    for emo_name in emo_list:
+    # Make masks for each emotion classifier in threads, masks are
+    # independent and NIfTI writes release the GIL, one thread per
+    # allocated CPU
+    num_workers = int(
+        os.environ.get(
+            "CR_SETUP_WORKERS",
+            min(
+                len(build_list),
+                int(os.environ.get("SLURM_CPUS_PER_TASK", os.cpu_count())),
+            ),
+        )
+    )
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        _ = list(executor.map(_build_mask, build_list))
+    _find_weight_maps.cache_clear()
 
-        # Make mask for voxels importance, significance
-        _ = _org_build("importance")
-        if mask_sig:
-            _ = _org_build("binary")
+    # Stacked weights of rebuilt maps are stale
+    process.clear_weight_cache(work_deriv)
 
 
 class ClassRest:
@@ -109,7 +151,8 @@ class ClassRest:
     according to the max value.
 
     Generated dataframes are uploaded to mysql db_emorep on
-    labarserv2, and CSVs are uploaded to Keoki.
+    labarserv2, and CSVs are uploaded to Keoki. Volumes and weights
+    are held as float32 throughout, so dot products are float32.
 
     Parameters
     ----------
@@ -188,85 +231,86 @@ class ClassRest:
 
     def label_vols(self):
         """Compute dot product and label each volume."""
-        # Check for existing data in db_emorep.tbl_dotprod
-        if sql_database.db_check(
-            self._subj, self._sess, self._proj_name, self._task_name
-        ):
-            print(
-                f"Data found in db_emorep.tbl_dotprod_{self._proj_name} "
-                + f"for {self._subj}, {self._sess}, {self._task_name}. "
-                + "Skipping ..."
+        # Shared db_emorep connection is closed once, before uploading
+        try:
+            # Check for existing data in db_emorep.tbl_dotprod
+            if sql_database.db_check(
+                self._subj, self._sess, self._proj_name, self._task_name
+            ):
+                print(
+                    f"Data found in db_emorep.tbl_dotprod_{self._proj_name} "
+                    + f"for {self._subj}, {self._sess}, {self._task_name}. "
+                    + "Skipping ..."
+                )
+                return
+
+            # Run setup
+            out_dir = os.path.join(
+                self._work_deriv, self._subj, self._sess, "func"
             )
-            return
-
-        # Run setup
-        out_dir = os.path.join(
-            self._work_deriv, self._subj, self._sess, "func"
-        )
-        if not os.path.exists(out_dir):
-            os.makedirs(out_dir)
-        self._setup()
-
-        # Convert volume values to zscore and split
-        res_vols = process.zscore_vols(
-            self._res_path,
-            self._mask_path,
-            out_dir,
-            self._log_dir,
-        )
+            Path(out_dir).mkdir(parents=True, exist_ok=True)
+            self._setup()
+
+            # Extract mask voxel values, z-scored during dot product
+            res_vox = process.mask_vols(self._res_path, self._mask_path)
+
+            # Conduct dot product calculations and volume label
+            do_dot = process.DoDot(res_vox, out_dir, self._mask_path)
+            do_dot.calc_dot(self._weight_maps, self._mask_sig)
+            do_dot.label_vol()
+            out_path = os.path.join(
+                out_dir,
+                f"df_dot-product_model-{self._model_name}_"
+                + f"con-{self._con_name}_task-{self._task_name}.csv",
+            )
+            do_dot.df_prod.to_csv(out_path, index=False)
 
-        # Conduct dot product calculations and volume label
-        do_dot = process.DoDot(res_vols, out_dir, self._mask_path)
-        do_dot.calc_dot(
-            self._weight_maps,
-            self._log_dir,
-            self._mask_sig,
-        )
-        do_dot.label_vol()
-        out_path = os.path.join(
-            out_dir,
-            f"df_dot-product_model-{self._model_name}_"
-            + f"con-{self._con_name}_task-{self._task_name}.csv",
-        )
-        do_dot.df_prod.to_csv(out_path, index=False)
+            # Update db_emorep.tbl_dotprod_*
+            print(
+                "Updating db_emorep.tbl_dotprod_* for "
+                + f"{self._subj} {self._sess} ..."
+            )
+            sql_database.db_update(
+                do_dot.df_prod,
+                self._subj,
+                self._sess,
+                self._proj_name,
+                self._mask_name,
+                self._model_name,
+                self._task_name,
+                self._con_name,
+                self._mask_sig,
+            )
+        finally:
+            sql_database.close_db()
 
-        # Update db_emorep.tbl_dotprod_*
-        print(
-            "Updating db_emorep.tbl_dotprod_* for "
-            + f"{self._subj} {self._sess} ..."
-        )
-        sql_database.db_update(
-            do_dot.df_prod.copy(),
+        # Upload output and clean, keeping output when CR_KEEP_OUTPUT
+        self._ds.ul_rest(self._subj, self._sess)
+        self._ds.clean_work(
             self._subj,
             self._sess,
-            self._proj_name,
-            self._mask_name,
-            self._model_name,
-            self._task_name,
-            self._con_name,
-            self._mask_sig,
+            keep_output=bool(os.environ.get("CR_KEEP_OUTPUT")),
         )
 
-        # Upload output and clean
-        self._ds.ul_rest(self._subj, self._sess)
-        self._ds.clean_work(self._subj, self._sess)
-
     def _setup(self):
         """Download and check for required files."""
         # Get cleaned resting data
         self._res_path = self._ds.dl_rest(self._subj, self._sess)
-        if not os.path.exists(self._res_path):
+        if not self._res_path or not os.path.isfile(self._res_path):
             raise FileNotFoundError(
                 f"Missing res4d.nii.gz files for {self._subj}"
             )
 
         # Orient to wf_setup output files
         self._mask_path = os.path.join(self._work_deriv, self._mask_name)
-        map_str = (
-            f"importance_model-{self._model_name}_task-{self._task_name}_"
-            + f"con-{self._con_name}_emo-*_map.nii.gz"
+        self._weight_maps = list(
+            _find_weight_maps(
+                self._work_deriv,
+                self._model_name,
+                self._task_name,
+                self._con_name,
+            )
         )
-        self._weight_maps = sorted(glob.glob(f"{self._work_deriv}/{map_str}"))
         if not self._weight_maps or not os.path.exists(self._mask_path):
             raise FileNotFoundError(
                 "Missing setup files, please execute workflow.wf_setup"
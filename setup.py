@@ -13,10 +13,12 @@ setup(
     },
     install_requires=[
         "nibabel>=5.1.0",
+        "numpy>=1.26.2",
         "pandas>=1.5.2",
         "paramiko>=3.3.1",
         "PyMySQL>=1.1.0",
         "setuptools>=65.5.1",
         "sshtunnel>=0.4.0",
     ],
+    extras_require={"numba": ["numba>=0.58.0"]},
 )
@@ -0,0 +1,271 @@
+"""Tests for classify_rest.process.
+
+Synthetic NIfTIs stand in for the template mask, cleaned rest EPI,
+and classifier importance/binary maps. The reference calculation
+mirrors the AFNI workflow replaced by process: z-score each volume
+by its mean and stdev within mask (3dBrickStat, 3dcalc) and then
+take the dot product with each weight map (3ddot -dodot), one volume
+and emotion at a time.
+
+"""
+
+import os
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pytest
+
+nib = pytest.importorskip("nibabel")
+from classify_rest import process  # noqa: E402
+
+EMO_LIST = ["amusement", "fear", "sadness"]
+SHAPE = (6, 5, 4)
+NUM_VOLS = 7
+
+
+@pytest.fixture(autouse=True)
+def _clear_mask_cache():
+    """Keep cached mask indices from leaking between tmp_paths."""
+    process._load_mask.cache_clear()
+    yield
+    process._load_mask.cache_clear()
+
+
+@pytest.fixture
+def syn_data(tmp_path):
+    """Write synthetic mask, rest EPI, and weight maps."""
+    rng = np.random.default_rng(0)
+    affine = np.eye(4)
+
+    mask = np.zeros(SHAPE, dtype=np.uint8)
+    mask[1:5, 1:4, :3] = 1
+    mask_path = str(tmp_path / "tpl_GM_mask.nii.gz")
+    nib.save(nib.Nifti1Image(mask, affine), mask_path)
+
+    # Rest EPI with nonzero mean and a constant (zero-variance) voxel
+    res = rng.normal(100, 10, SHAPE + (NUM_VOLS,)).astype(np.float32)
+    res[2, 2, 1, :] = 5.0
+    res_path = str(tmp_path / "res4d.nii.gz")
+    nib.save(nib.Nifti1Image(res, affine), res_path)
+
+    weight_maps = []
+    for emo in EMO_LIST:
+        imp_path = str(
+            tmp_path
+            / f"importance_model-sep_task-movies_con-stim_emo-{emo}_map.nii.gz"
+        )
+        nib.save(
+            nib.Nifti1Image(
+                rng.normal(0, 1, SHAPE).astype(np.float32), affine
+            ),
+            imp_path,
+        )
+        nib.save(
+            nib.Nifti1Image(
+                (rng.random(SHAPE) > 0.5).astype(np.float32), affine
+            ),
+            imp_path.replace("importance", "binary"),
+        )
+        weight_maps.append(imp_path)
+
+    return {
+        "mask_path": mask_path,
+        "res_path": res_path,
+        "weight_maps": weight_maps,
+        "out_dir": str(tmp_path),
+    }
+
+
+def _ref_dot(
+    res_path: str,
+    mask_path: str,
+    weight_maps: list,
+    mask_sig: bool,
+    ddof: int = 0,
+) -> np.ndarray:
+    """Return (num_vols, num_emo) products, one volume at a time."""
+    mask = nib.load(mask_path).get_fdata() != 0
+    res = nib.load(res_path).get_fdata()
+    prod = np.zeros((res.shape[-1], len(weight_maps)))
+    for vol in range(res.shape[-1]):
+        vol_vox = res[..., vol][mask]
+        vol_z = (vol_vox - vol_vox.mean()) / vol_vox.std(ddof=ddof)
+        for idx, weight_path in enumerate(weight_maps):
+            weight = nib.load(weight_path).get_fdata()[mask]
+            if mask_sig:
+                bin_path = weight_path.replace("importance", "binary")
+                sig = nib.load(bin_path).get_fdata()[mask] > 0
+                weight = np.where(sig, weight, 0)
+            prod[vol, idx] = np.dot(vol_z, weight)
+    return prod
+
+
+def _calc_dot(syn_data: dict, mask_sig: bool) -> pd.DataFrame:
+    """Return df_prod from DoDot on syn_data."""
+    res_vox = process.mask_vols(syn_data["res_path"], syn_data["mask_path"])
+    do_dot = process.DoDot(res_vox, syn_data["out_dir"], syn_data["mask_path"])
+    do_dot.calc_dot(syn_data["weight_maps"], mask_sig)
+    do_dot.label_vol()
+    return do_dot.df_prod
+
+
+@pytest.mark.parametrize("chunk_vols", [1, 3, 32])
+def test_mask_vols(syn_data, chunk_vols):
+    mask = nib.load(syn_data["mask_path"]).get_fdata() != 0
+    res = nib.load(syn_data["res_path"]).get_fdata()
+    res_vox = process.mask_vols(
+        syn_data["res_path"], syn_data["mask_path"], chunk_vols=chunk_vols
+    )
+    assert res_vox.dtype == np.float32
+    assert res_vox.flags.c_contiguous
+    np.testing.assert_allclose(res_vox, res[mask], rtol=1e-6)
+
+
+def test_zscore_vols_ddof0():
+    rng = np.random.default_rng(1)
+    res_vox = rng.normal(50, 5, (40, 6))
+    vol_z = process.zscore_vols(res_vox)
+    np.testing.assert_allclose(vol_z.mean(axis=0), 0, atol=1e-12)
+    np.testing.assert_allclose(vol_z.std(axis=0, ddof=0), 1)
+
+
+def test_zscore_vols_zero_variance():
+    res_vox = np.ones((40, 3))
+    with pytest.raises(ValueError):
+        process.zscore_vols(res_vox)
+
+
+@pytest.mark.parametrize("mask_sig", [False, True])
+def test_calc_dot_numpy_matches_reference(syn_data, monkeypatch, mask_sig):
+    monkeypatch.setattr(process, "numba", None)
+    df_prod = _calc_dot(syn_data, mask_sig)
+    ref = _ref_dot(
+        syn_data["res_path"],
+        syn_data["mask_path"],
+        syn_data["weight_maps"],
+        mask_sig,
+    )
+    assert list(df_prod.columns) == (
+        ["volume"] + [f"emo_{x}" for x in EMO_LIST] + ["label_max"]
+    )
+    assert df_prod["volume"].tolist() == list(range(1, NUM_VOLS + 1))
+    np.testing.assert_allclose(
+        df_prod[[f"emo_{x}" for x in EMO_LIST]].to_numpy(),
+        ref,
+        rtol=1e-4,
+        atol=1e-3,
+    )
+
+
+@pytest.mark.parametrize("mask_sig", [False, True])
+def test_calc_dot_numba_matches_numpy(syn_data, monkeypatch, mask_sig):
+    pytest.importorskip("numba")
+    assert process.numba is not None
+    df_numba = _calc_dot(syn_data, mask_sig)
+    monkeypatch.setattr(process, "numba", None)
+    df_numpy = _calc_dot(syn_data, mask_sig)
+    emo_cols = [f"emo_{x}" for x in EMO_LIST]
+    np.testing.assert_allclose(
+        df_numba[emo_cols].to_numpy(),
+        df_numpy[emo_cols].to_numpy(),
+        rtol=1e-4,
+        atol=1e-3,
+    )
+    assert df_numba["label_max"].tolist() == df_numpy["label_max"].tolist()
+
+
+def test_calc_dot_labels_match_afni_ddof(syn_data, monkeypatch):
+    # 3dBrickStat -stdev is the sample stdev, process uses the
+    # population stdev, which rescales each volume and not its label
+    monkeypatch.setattr(process, "numba", None)
+    df_prod = _calc_dot(syn_data, True)
+    ref = _ref_dot(
+        syn_data["res_path"],
+        syn_data["mask_path"],
+        syn_data["weight_maps"],
+        True,
+        ddof=1,
+    )
+    ref_labels = [EMO_LIST[x] for x in ref.argmax(axis=1)]
+    assert df_prod["label_max"].tolist() == ref_labels
+
+
+@pytest.mark.parametrize("use_numba", [False, True])
+def test_calc_dot_zero_variance_volume(syn_data, monkeypatch, use_numba):
+    if use_numba:
+        pytest.importorskip("numba")
+    else:
+        monkeypatch.setattr(process, "numba", None)
+    res_vox = process.mask_vols(syn_data["res_path"], syn_data["mask_path"])
+    res_vox[:, 2] = 3.0
+    do_dot = process.DoDot(res_vox, syn_data["out_dir"], syn_data["mask_path"])
+    with pytest.raises(ValueError):
+        do_dot.calc_dot(syn_data["weight_maps"], False)
+
+
+@pytest.mark.parametrize("num_tiles", [1, 3])
+@pytest.mark.parametrize("block_bytes", [NUM_VOLS * 4, 262144])
+def test_zdot_voxel_blocks(syn_data, block_bytes, num_tiles):
+    # Small and whole-array blocks over one or several volume tiles
+    # give the same products
+    pytest.importorskip("numba")
+    res_vox = process.mask_vols(syn_data["res_path"], syn_data["mask_path"])
+    rng = np.random.default_rng(2)
+    weight_arr = rng.normal(0, 1, (len(EMO_LIST), res_vox.shape[0]))
+    weight_arr = weight_arr.astype(np.float32)
+    weight_arr[:, ::3] = 0
+    out = np.empty((len(EMO_LIST), NUM_VOLS), dtype=np.float32)
+    process._zdot(res_vox, weight_arr, out, block_bytes, num_tiles)
+    np.testing.assert_allclose(
+        out,
+        weight_arr @ process.zscore_vols(res_vox),
+        rtol=1e-4,
+        atol=1e-3,
+    )
+
+
+def test_load_weight_arr_cache(syn_data):
+    weight_maps = syn_data["weight_maps"]
+    weight_arr = process.load_weight_arr(
+        weight_maps, syn_data["mask_path"], True
+    )
+    cached_arr = process.load_weight_arr(
+        weight_maps, syn_data["mask_path"], True
+    )
+    assert isinstance(cached_arr, np.memmap)
+    assert cached_arr.shape == (len(EMO_LIST), weight_arr.shape[1])
+    np.testing.assert_array_equal(weight_arr, cached_arr)
+
+    # A concurrent job's temp file is left for its os.replace
+    tmp_path = Path(syn_data["out_dir"]) / ".tmp-weight_arr_x.npy"
+    tmp_path.touch()
+    process.clear_weight_cache(syn_data["out_dir"])
+    assert not list(Path(syn_data["out_dir"]).glob("weight_arr_*"))
+    assert tmp_path.exists()
+
+
+def test_load_weight_arr_missing_binary(syn_data):
+    weight_maps = syn_data["weight_maps"]
+    os.remove(weight_maps[0].replace("importance", "binary"))
+    with pytest.raises(FileNotFoundError, match="Expected binary mask"):
+        process.load_weight_arr(weight_maps, syn_data["mask_path"], True)
+
+
+def test_label_vol_ties():
+    do_dot = process.DoDot(None, None, None)
+    do_dot.df_prod = pd.DataFrame(
+        {
+            "volume": [1, 2, 3],
+            "emo_amusement": [1.0, 2.0, 0.5],
+            "emo_fear": [1.0, 3.0, 0.5],
+            "emo_sadness": [0.0, 3.0, 0.5],
+        }
+    )
+    do_dot.label_vol()
+
+    # Ties resolve to the first emotion column, as np.argmax
+    assert do_dot.df_prod["label_max"].tolist() == [
+        "amusement",
+        "fear",
+        "amusement",
+    ]
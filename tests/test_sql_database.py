@@ -0,0 +1,142 @@
+"""Tests for classify_rest.sql_database.DbBatchWriter.
+
+A fake connection supplies the tbl_dotprod_* column order, in the
+order of information_schema, and records executemany input so the
+row layout can be checked against _insert_template.
+
+"""
+
+import pandas as pd
+import pytest
+
+pytest.importorskip("pymysql")
+pytest.importorskip("sshtunnel")
+from classify_rest import sql_database  # noqa: E402
+
+# Deliberately not the column order of df_prod
+COL_LIST = [
+    "subj_id",
+    "sess_id",
+    "fsl_model_id",
+    "fsl_task_id",
+    "fsl_con_id",
+    "mask_id",
+    "volume",
+    "emo_fear",
+    "emo_amusement",
+    "label_max",
+]
+
+# Insert statement expected for COL_LIST
+SQL_CMD = (
+    "insert ignore into tbl_dotprod_emorep "
+    + f"({', '.join(COL_LIST)}) "
+    + f"values ({', '.join(['%s'] * len(COL_LIST))})"
+)
+
+
+class _FakeDb:
+    """Stand in for DbConnect."""
+
+    def __init__(self):
+        self.exec_calls = []
+
+    def fetch_rows(self, sql_cmd: str) -> list:
+        assert "information_schema.columns" in sql_cmd
+        return [(x,) for x in COL_LIST]
+
+    def exec_many(self, sql_cmd: str, value_list: list):
+        self.exec_calls.append((sql_cmd, list(value_list)))
+
+
+class _FakeKeyMap:
+    """Stand in for _KeyMap."""
+
+    def subj_map(self, subj, proj_name):
+        return 9
+
+    def sess_map(self, sess):
+        return 2
+
+    def fsl_task_map(self, task):
+        return 1
+
+    def fsl_model_map(self, model):
+        return 3
+
+    def fsl_con_map(self, con):
+        return 4
+
+    def mask_map(self, mask, mask_sig):
+        return 6 if mask_sig else 5
+
+    def emo_map(self, emo_col):
+        return emo_col.map({"amusement": 1, "fear": 7}).astype("int64")
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    """Patch shared connection and insert template cache."""
+    db_con = _FakeDb()
+    monkeypatch.setattr(
+        sql_database, "_shared_db", lambda: (db_con, _FakeKeyMap())
+    )
+    monkeypatch.setattr(sql_database, "_INSERT_TEMPLATE", {})
+    return db_con
+
+
+def _df_prod() -> pd.DataFrame:
+    """Return df_prod as made by process.DoDot."""
+    return pd.DataFrame(
+        {
+            "volume": [1, 2],
+            "emo_amusement": [0.5, -1.0],
+            "emo_fear": [0.25, 2.0],
+            "label_max": ["amusement", "fear"],
+        }
+    )
+
+
+def _add_args() -> tuple:
+    """Return DbBatchWriter.add args following df."""
+    return ("sub-ER0009", "ses-day2", "tpl_GM_mask.nii.gz", "sep")
+
+
+def test_insert_template_column_order(fake_db):
+    sql_cmd, col_list = sql_database._insert_template("emorep", fake_db)
+    assert col_list == COL_LIST
+    assert sql_cmd == SQL_CMD
+
+
+def test_batch_writer_row_layout(fake_db):
+    df = _df_prod()
+    df_orig = df.copy()
+    with sql_database.DbBatchWriter("emorep") as writer:
+        writer.add(df, *_add_args(), "movies", "stim", True)
+
+    assert len(fake_db.exec_calls) == 1
+    sql_cmd, rows = fake_db.exec_calls[0]
+    assert sql_cmd == SQL_CMD
+    assert rows == [
+        (9, 2, 3, 1, 4, 6, 1, 0.25, 0.5, 1),
+        (9, 2, 3, 1, 4, 6, 2, 2.0, -1.0, 7),
+    ]
+
+    # Native python scalars for pymysql, df is not modified
+    assert all(type(x) in (int, float) for row in rows for x in row)
+    pd.testing.assert_frame_equal(df, df_orig)
+
+
+def test_batch_writer_flush_rows(fake_db):
+    with sql_database.DbBatchWriter("emorep", flush_rows=3) as writer:
+        for _ in range(3):
+            writer.add(_df_prod(), *_add_args(), "movies", "stim", False)
+    assert [len(x[1]) for x in fake_db.exec_calls] == [4, 2]
+
+
+def test_batch_writer_no_flush_on_error(fake_db):
+    with pytest.raises(RuntimeError):
+        with sql_database.DbBatchWriter("emorep") as writer:
+            writer.add(_df_prod(), *_add_args(), "movies", "stim", False)
+            raise RuntimeError
+    assert fake_db.exec_calls == []